@@ -1,20 +1,47 @@
 import os
-from flask import Flask, jsonify
-from sqlalchemy import create_engine, text
+import asyncio
+import hashlib
+import sys
+import time
+from quart import Quart, request
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from datetime import datetime
 import logging
+import orjson
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 # Environment variables
 env = os.environ
 
-def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-    return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
+# Async driver used by the ASGI app (psycopg 3 speaks asyncio natively)
+ASYNC_DRIVER = 'postgresql+psycopg'
+
+# Pool sizing - every gunicorn worker (WEB_CONCURRENCY, one per core by
+# default, see gunicorn.conf.py) owns a pool, so the defaults split one
+# DB_MAX_CONNECTIONS budget between them to stay under max_connections
+# (each still gets at least two, so very high worker counts need a larger budget)
+DB_MAX_CONNECTIONS = int(env.get('DB_MAX_CONNECTIONS', '90'))
+WORKERS = int(env.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+_worker_connections = max(DB_MAX_CONNECTIONS // WORKERS, 2)
+DB_POOL_SIZE = int(env.get('DB_POOL_SIZE', _worker_connections * 3 // 5 or 1))
+DB_MAX_OVERFLOW = int(env.get('DB_MAX_OVERFLOW', _worker_connections - DB_POOL_SIZE))
+DB_POOL_RECYCLE = int(env.get('DB_POOL_RECYCLE', '3600'))
+DB_POOL_TIMEOUT = int(env.get('DB_POOL_TIMEOUT', '5'))
+
+def my_create_engine(conn_str, pool_recycle=DB_POOL_RECYCLE, pool_size=DB_POOL_SIZE,
+                     max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True, pool_timeout=DB_POOL_TIMEOUT):
+    # Legacy postgresql:// strings are switched over to the async driver
+    url = make_url(conn_str).set(drivername=ASYNC_DRIVER)
+    return create_async_engine(url, pool_recycle=pool_recycle, pool_size=pool_size,
+                               max_overflow=max_overflow, pool_pre_ping=pool_pre_ping,
+                               pool_timeout=pool_timeout)
 
 def get_db_credentials():
     """Get database credentials from environment variables."""
@@ -26,113 +53,203 @@ def get_db_credentials():
 
 def create_connection_string(db_name, username, password, host, port):
     """Create a PostgreSQL connection string for the specified database."""
-    return f"postgresql://{username}:{password}@{host}:{port}/{db_name}"
+    return f"{ASYNC_DRIVER}://{username}:{password}@{host}:{port}/{db_name}"
 
-# Database connection - use postgres database for timestamp queries
-username, password, host, port = get_db_credentials()
-if username and password:
-    POSTGRES_CONN_STR = create_connection_string('postgres', username, password, host, port)
-    AUTH_ENGINE = my_create_engine(POSTGRES_CONN_STR)
-else:
+def build_engine():
+    """Resolve the configured connection once and build the engine, or None if unconfigured."""
+    username, password, host, port = get_db_credentials()
+    if username and password:
+        return my_create_engine(create_connection_string('postgres', username, password, host, port))
     # Fallback to old ADMIN_CONN_STR for backward compatibility
-    ADMIN_CONN_STR = env.get('ADMIN_CONN_STR')
-    if ADMIN_CONN_STR:
-        AUTH_ENGINE = my_create_engine(ADMIN_CONN_STR)
-    else:
-        AUTH_ENGINE = None
+    admin_conn_str = env.get('ADMIN_CONN_STR')
+    if admin_conn_str:
+        return my_create_engine(admin_conn_str)
+    return None
+
+# Database connection - use postgres database for timestamp queries
+AUTH_ENGINE = build_engine()
+
+# Statements used by the views, built once at import rather than per request
+TIMESTAMP_SQL = text("SELECT NOW() as current_timestamp")
+DATABASES_SQL = text("""
+    SELECT datname, datname LIKE 'db\\_%' AS is_tenant
+    FROM pg_database 
+    WHERE datistemplate = false 
+    AND datname NOT IN ('postgres') 
+    ORDER BY datname
+""").execution_options(yield_per=1000)
+
+# Tenant databases change rarely, so /databases is served from memory for
+# DATABASES_CACHE_TTL seconds: (expires_at, body, etag)
+DATABASES_CACHE_TTL = int(env.get('DATABASES_CACHE_TTL', '60'))
+_databases_cache = None
+
+# Clients only need second-level precision from /timestamp, so the database
+# time is reused for TIMESTAMP_CACHE_SECONDS: (expires_at, timestamp)
+TIMESTAMP_CACHE_SECONDS = 1.0
+_timestamp_cache = (float('-inf'), None)
+
+# Load balancer probes arrive far more often than the database state changes,
+# so a successful health check is trusted for HEALTH_CACHE_SECONDS
+HEALTH_CACHE_SECONDS = 2.0
+_last_healthy_at = float('-inf')
+
+# Refreshes still running, by cache name, so concurrent misses share one query
+_inflight = {}
+
+async def shared_fetch(name, fetch):
+    """Await fetch(), sharing a single in-flight call between concurrent callers."""
+    task = _inflight.get(name)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight[name] = task
+        task.add_done_callback(lambda _: _inflight.pop(name, None))
+    # A caller that disconnects must not cancel the query the others await
+    return await asyncio.shield(task)
+
+def ojson(obj, status=200):
+    """Serialize obj with orjson (datetimes included) into a JSON response."""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+@app.after_serving
+async def dispose_engine():
+    if AUTH_ENGINE is not None:
+        await AUTH_ENGINE.dispose()
 
 @app.route('/')
-def home():
-    return jsonify({
+async def home():
+    return ojson({
         'message': 'Flask PostgreSQL Timestamp Server',
         'status': 'running'
     })
 
+async def fetch_timestamp():
+    """Query the current timestamp from the database and cache it."""
+    global _timestamp_cache
+    now = time.monotonic()
+    async with AUTH_ENGINE.connect() as connection:
+        result = await connection.execute(TIMESTAMP_SQL)
+        timestamp = result.fetchone()[0]
+    _timestamp_cache = (now + TIMESTAMP_CACHE_SECONDS, timestamp)
+    return timestamp
+
 @app.route('/timestamp')
-def get_timestamp():
+async def get_timestamp():
     try:
-        # Query the current timestamp from the database
-        with AUTH_ENGINE.connect() as connection:
-            result = connection.execute(text("SELECT NOW() as current_timestamp"))
-            timestamp = result.fetchone()[0]
+        # Requests within TIMESTAMP_CACHE_SECONDS share one NOW() query, and
+        # concurrent requests on an expired cache wait for the same refresh
+        expires_at, timestamp = _timestamp_cache
+        if time.monotonic() >= expires_at:
+            timestamp = await shared_fetch('timestamp', fetch_timestamp)
             
-            return jsonify({
-                'timestamp': timestamp.isoformat(),
-                'source': 'postgresql_database',
-                'status': 'success'
-            })
+        response = ojson({
+            'timestamp': timestamp,
+            'source': 'postgresql_database',
+            'status': 'success'
+        })
+        response.headers['Cache-Control'] = f'public, max-age={TIMESTAMP_CACHE_SECONDS:g}'
+        return response
     except Exception as e:
         logger.error(f"Database error: {str(e)}")
-        return jsonify({
+        return ojson({
             'error': 'Failed to retrieve timestamp from database',
             'details': str(e),
             'status': 'error'
-        }), 500
+        }, 500)
 
 @app.route('/health')
-def health_check():
+async def health_check():
+    global _last_healthy_at
     try:
-        # Test database connection
-        with AUTH_ENGINE.connect() as connection:
-            connection.execute(text("SELECT 1"))
+        # Probes within HEALTH_CACHE_SECONDS of a good check skip the database
+        if time.monotonic() - _last_healthy_at >= HEALTH_CACHE_SECONDS:
+            # Checking out a connection is the test: pool_pre_ping pings
+            # pooled connections and new ones have just connected
+            async with AUTH_ENGINE.connect():
+                pass
+            _last_healthy_at = time.monotonic()
             
-        return jsonify({
+        response = ojson({
             'status': 'healthy',
             'database': 'connected',
-            'timestamp': datetime.now().isoformat()
+            'timestamp': datetime.now()
         })
+        # Let a fronting proxy answer probes for the same window (see nginx.conf.example)
+        response.headers['Cache-Control'] = f'public, max-age={HEALTH_CACHE_SECONDS:g}'
+        return response
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
-        return jsonify({
+        response = ojson({
             'status': 'unhealthy',
             'database': 'disconnected',
             'error': str(e),
-            'timestamp': datetime.now().isoformat()
-        }), 503
+            'timestamp': datetime.now()
+        }, 503)
+        # Never cache a failure - the next probe must reach the database
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+async def refresh_database_listing():
+    """Query the database listing and store its body and ETag in the cache."""
+    global _databases_cache
+    now = time.monotonic()
+    system_dbs = []
+    tenant_dbs = []
+    
+    async with AUTH_ENGINE.connect() as connection:
+        # Query all non-template databases, categorized by PostgreSQL and
+        # streamed in batches rather than materialized with fetchall()
+        result = await connection.stream(DATABASES_SQL)
+        
+        # Single pass over the rows; bind the appends once, outside the loop
+        add_tenant, add_system = tenant_dbs.append, system_dbs.append
+        async for db_name, is_tenant in result:
+            if is_tenant:
+                add_tenant(db_name)
+            else:
+                add_system(db_name)
+    
+    body = orjson.dumps({
+        'databases': {
+            'system': system_dbs,
+            'tenants': tenant_dbs,
+            'total_count': len(system_dbs) + len(tenant_dbs)
+        },
+        'status': 'success'
+    })
+    # The ETag only fingerprints the body; it is not a security boundary
+    etag = hashlib.md5(body, usedforsecurity=False).hexdigest()
+    _databases_cache = (now + DATABASES_CACHE_TTL, body, etag)
+    return body, etag
+
+async def load_database_listing():
+    """Return the cached /databases body and its ETag, refreshing after the TTL."""
+    if _databases_cache is not None and time.monotonic() < _databases_cache[0]:
+        return _databases_cache[1], _databases_cache[2]
+    return await shared_fetch('databases', refresh_database_listing)
 
 @app.route('/databases')
-def list_databases():
+async def list_databases():
     try:
-        with AUTH_ENGINE.connect() as connection:
-            # Query all non-template databases
-            result = connection.execute(text("""
-                SELECT datname 
-                FROM pg_database 
-                WHERE datistemplate = false 
-                AND datname NOT IN ('postgres') 
-                ORDER BY datname
-            """))
-            
-            databases = [row[0] for row in result.fetchall()]
-            
-            # Categorize databases
-            system_dbs = []
-            tenant_dbs = []
-            
-            for db_name in databases:
-                if db_name in ['auth', 'constants']:
-                    system_dbs.append(db_name)
-                elif db_name.startswith('db_'):
-                    tenant_dbs.append(db_name)
-                else:
-                    system_dbs.append(db_name)
-            
-            return jsonify({
-                'databases': {
-                    'system': system_dbs,
-                    'tenants': tenant_dbs,
-                    'total_count': len(databases)
-                },
-                'status': 'success'
-            })
+        body, etag = await load_database_listing()
+        
+        # Repeat clients revalidate with If-None-Match and get an empty 304;
+        # weak validators (W/"...") match too, as RFC 9110 requires for GET
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f'max-age={DATABASES_CACHE_TTL}'
+        return response
             
     except Exception as e:
         logger.error(f"Database listing error: {str(e)}")
-        return jsonify({
+        return ojson({
             'error': 'Failed to retrieve database list',
             'details': str(e),
             'status': 'error'
-        }), 500
+        }, 500)
 
 if __name__ == '__main__':
     # Verify database configuration is available
@@ -140,5 +257,10 @@ if __name__ == '__main__':
         logger.error("Database connection not configured. Please set DB_USERNAME, DB_PASSWORD, DB_HOST, DB_PORT or ADMIN_CONN_STR environment variables")
         exit(1)
     
-    logger.info("Starting Flask server...")
+    # psycopg's async driver can't run on Windows' default Proactor loop
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    
+    # Development server only - deploy with `gunicorn app:app` (see gunicorn.conf.py)
+    logger.info("Starting Quart server...")
     app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
@@ -0,0 +1,21 @@
+"""
+Gunicorn configuration for the API server.
+Picked up automatically by `gunicorn app:app` when run from the project root.
+"""
+
+import multiprocessing
+import os
+
+bind = f"{os.getenv('APP_HOST', '0.0.0.0')}:{os.getenv('APP_PORT', '5000')}"
+
+# The views are async, so each worker multiplexes its requests on an asyncio
+# event loop (uvloop when installed) - one worker per core is enough, no
+# gevent monkey-patching needed. Each worker owns its own connection pool;
+# app.py sizes them from WEB_CONCURRENCY so together they fit in
+# DB_MAX_CONNECTIONS.
+worker_class = 'uvicorn_worker.UvicornWorker'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+# Outlive typical load balancer idle timeouts so connections are reused
+keepalive = 65
+timeout = 60
@@ -27,6 +27,19 @@ target_metadata = None
 # ... etc.
 
 
+# Filter version locations to exclude tenant_versions during upgrades.
+# Done once here, before either run mode, rather than inside each of them
+version_locations = config.get_main_option("version_locations")
+if version_locations and not os.getenv('ALEMBIC_ALLOW_TENANT_MIGRATIONS'):
+    # Only include system migrations (migrations/versions)
+    filtered_locations = [
+        location for location in version_locations.split(':')
+        if 'tenant_versions' not in location
+    ]
+    if filtered_locations:
+        config.set_main_option("version_locations", ':'.join(filtered_locations))
+
+
 def include_object(object, name, type_, reflected, compare_to):
     """Filter out tenant migrations when running system upgrades."""
     # Only exclude during upgrade operations, not during revision generation
@@ -52,18 +65,6 @@ def run_migrations_offline() -> None:
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    
-    # Filter version locations to exclude tenant_versions during upgrades
-    version_locations = config.get_main_option("version_locations")
-    if version_locations and not os.getenv('ALEMBIC_ALLOW_TENANT_MIGRATIONS'):
-        # Only include system migrations (migrations/versions)
-        filtered_locations = []
-        for location in version_locations.split(':'):
-            if 'tenant_versions' not in location:
-                filtered_locations.append(location)
-        if filtered_locations:
-            config.set_main_option("version_locations", ':'.join(filtered_locations))
-    
     context.configure(
         url=url,
         target_metadata=target_metadata,
@@ -82,17 +83,13 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    # Filter version locations to exclude tenant_versions during upgrades
-    version_locations = config.get_main_option("version_locations")
-    if version_locations and not os.getenv('ALEMBIC_ALLOW_TENANT_MIGRATIONS'):
-        # Only include system migrations (migrations/versions)
-        filtered_locations = []
-        for location in version_locations.split(':'):
-            if 'tenant_versions' not in location:
-                filtered_locations.append(location)
-        if filtered_locations:
-            config.set_main_option("version_locations", ':'.join(filtered_locations))
-    
+    # Reuse a connection handed in through config.attributes (e.g. by
+    # scripts/run_migrations/run_initial_setup.py) instead of opening one
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        do_run_migrations(connection)
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
@@ -100,12 +97,17 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata
-        )
+        do_run_migrations(connection)
 
-        with context.begin_transaction():
-            context.run_migrations()
+
+def do_run_migrations(connection) -> None:
+    """Run migrations on an already open connection."""
+    context.configure(
+        connection=connection, target_metadata=target_metadata
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
 
 
 if context.is_offline_mode():
@@ -5,8 +5,7 @@ Revises: 530a3391a17b
 Create Date: 2025-06-09 16:38:26.940639
 
 """
-import random
-import string
+import secrets
 from typing import Sequence, Union
 
 from alembic import op
@@ -18,12 +17,15 @@ down_revision: Union[str, None] = '530a3391a17b'
 branch_labels: Union[str, Sequence[str], None] = None
 depends_on: Union[str, Sequence[str], None] = None
 
+# Tenant schema DDL; also executed directly by run_initial_setup.py
+LEADS_DDL = "CREATE TABLE leads (id SERIAL PRIMARY KEY, name VARCHAR(255), email VARCHAR(255), phone VARCHAR(255))"
+
 
 def upgrade(tenant_name: str = None) -> str:
     if not tenant_name:
-        tenant_name = "db_" + "".join(random.choices(string.ascii_lowercase + string.digits, k=10))
+        tenant_name = "db_" + secrets.token_hex(5)
 
-    op.execute(f"CREATE TABLE leads (id SERIAL PRIMARY KEY, name VARCHAR(255), email VARCHAR(255), phone VARCHAR(255))");
+    op.execute(LEADS_DDL);
 
     return tenant_name
 
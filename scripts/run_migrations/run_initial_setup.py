@@ -5,8 +5,7 @@ This script handles the initial setup and configuration of the Flask application
 """
 
 import os
-import random
-import string
+import secrets
 import sys
 import subprocess
 from pathlib import Path
@@ -15,10 +14,16 @@ from pathlib import Path
 project_root = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(project_root))
 
+# Tenant registration; bound once per batch so PostgreSQL parses it once
+REGISTER_COMPANY_SQL = (
+    "INSERT INTO companies (db_name, name, email, password) "
+    "VALUES (:db_name, :name, :email, :password)"
+)
+
 def check_python_version():
     """Check if Python version is compatible."""
-    if sys.version_info < (3, 8):
-        print("ERROR: Python 3.8 or higher is required")
+    if sys.version_info < (3, 9):
+        print("ERROR: Python 3.9 or higher is required")
         return False
     return True
 
@@ -82,8 +87,8 @@ def get_db_credentials():
     return username, password, host, port
 
 def create_connection_string(db_name, username, password, host, port):
-    """Create a PostgreSQL connection string for the specified database."""
-    return f"postgresql://{username}:{password}@{host}:{port}/{db_name}"
+    """Create a PostgreSQL connection string for the specified database (psycopg 3 driver)."""
+    return f"postgresql+psycopg://{username}:{password}@{host}:{port}/{db_name}"
 
 def test_database_connection():
     """Test database connection if credentials are provided."""
@@ -130,8 +135,10 @@ def run_initial_migrations():
             return True
         
         from sqlalchemy import create_engine, text
+        from sqlalchemy.pool import NullPool
         from alembic.config import Config
         from alembic import command
+        from alembic.runtime.migration import MigrationContext
         
         def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
             return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
@@ -160,82 +167,108 @@ def run_initial_migrations():
         # Now run the migrations to create tables on each specific database
         alembic_cfg = Config(str(project_root / "alembic.ini"))
         
+        def upgrade_database(db_name, revision):
+            """Upgrade db_name to revision; return False if it was already there."""
+            db_engine = create_engine(engine.url.set(database=db_name), poolclass=NullPool)
+            with db_engine.begin() as connection:
+                # A single alembic_version read avoids the full upgrade
+                # bootstrap when the setup script is re-run
+                if MigrationContext.configure(connection).get_current_revision() == revision:
+                    upgraded = False
+                else:
+                    # Hand alembic an open connection (picked up by migrations/env.py)
+                    # so each upgrade runs in a single transaction on that connection
+                    alembic_cfg.attributes['connection'] = connection
+                    command.upgrade(alembic_cfg, revision)
+                    del alembic_cfg.attributes['connection']
+                    upgraded = True
+            db_engine.dispose()
+            return upgraded
+        
         # Run auth migration on auth database
-        auth_conn_str = create_connection_string('auth', username, password, host, port)
-        alembic_cfg.set_main_option("sqlalchemy.url", auth_conn_str)
-        command.upgrade(alembic_cfg, "868004f7a00f")
-        print("Created auth tables")
+        if upgrade_database('auth', "868004f7a00f"):
+            print("Created auth tables")
+        else:
+            print("Auth tables already up to date")
         
         # Run constants migration on constants database
-        constants_conn_str = create_connection_string('constants', username, password, host, port)
-        alembic_cfg.set_main_option("sqlalchemy.url", constants_conn_str)
-        command.upgrade(alembic_cfg, "530a3391a17b")
-        print("Created constants tables")
-        
-        tenant_names = []
-        
-        # First create the tenant databases using autocommit
-        for i in range(3):
-            tenant_name = "db_" + "".join(random.choices(string.ascii_lowercase + string.digits, k=10))
-            try:
-                with engine_autocommit.connect() as connection:
-                    connection.execute(text(f"CREATE DATABASE {tenant_name}"))
-                    print(f"Created tenant database: {tenant_name}")
-                tenant_names.append(tenant_name)
-            except Exception as e:
-                if "already exists" not in str(e):
-                    print(f"ERROR: Failed to create tenant database {tenant_name}: {e}")
-                # Continue with other tenants
+        if upgrade_database('constants', "530a3391a17b"):
+            print("Created constants tables")
+        else:
+            print("Constants tables already up to date")
         
         # Now run the tenant migration to create tables and insert company records
         import importlib.util
+        from concurrent.futures import ThreadPoolExecutor
         
-        # Import the migration file dynamically
+        # Import the migration file dynamically for its tenant schema DDL
         migration_file = project_root / "migrations" / "versions" / "fe3e21032723_create_tenant_database.py"
         spec = importlib.util.spec_from_file_location("tenant_migration", migration_file)
         tenant_migration = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(tenant_migration)
         
-        # Run tenant migrations to create tables in each tenant database
-        for tenant_name in tenant_names:
+        def create_tenant(tenant_name):
+            """Create one tenant database and its tables; return its name if the database was created."""
+            try:
+                # CREATE DATABASE cannot run in a transaction, so check out an autocommit connection
+                with engine_autocommit.connect() as connection:
+                    connection.execute(text(f"CREATE DATABASE {tenant_name}"))
+                    print(f"Created tenant database: {tenant_name}")
+            except Exception as e:
+                if "already exists" not in str(e):
+                    print(f"ERROR: Failed to create tenant database {tenant_name}: {e}")
+                return None
+            
             try:
-                # Connect to the specific tenant database to create tables
-                tenant_conn_str = create_connection_string(tenant_name, username, password, host, port)
-                tenant_engine = my_create_engine(tenant_conn_str)
+                # Each tenant needs exactly one connection, so connect through a
+                # pool-less engine rather than keeping a pooled engine per tenant
+                tenant_engine = create_engine(engine.url.set(database=tenant_name), poolclass=NullPool)
                 
-                with tenant_engine.connect() as connection:
-                    # Set up the alembic context for direct execution
-                    from alembic.runtime.migration import MigrationContext
-                    from alembic.operations import Operations
-                    
-                    mc = MigrationContext.configure(connection)
-                    ops = Operations(mc)
-                    
-                    # Store the op context for the migration functions
-                    tenant_migration.op = ops
-                    
-                    tenant_migration.upgrade(tenant_name)
-                    connection.commit()
-                    print(f"Created tables for tenant: {tenant_name}")
+                # The DDL is literal SQL, so run it directly instead of
+                # bootstrapping an alembic MigrationContext per tenant
+                with tenant_engine.begin() as connection:
+                    connection.execute(text(tenant_migration.LEADS_DDL))
+                print(f"Created tables for tenant: {tenant_name}")
+                
+                tenant_engine.dispose()
                     
             except Exception as e:
                 print(f"ERROR: Failed to create tables for tenant {tenant_name}: {e}")
-                # Continue with other tenants
+            
+            return tenant_name
+        
+        new_tenant_names = [
+            "db_" + secrets.token_hex(5)
+            for i in range(3)
+        ]
+        
+        # Tenants are independent, so provision them in parallel; the worker
+        # count stays within the setup engine's pool size
+        with ThreadPoolExecutor(max_workers=min(len(new_tenant_names), 8)) as executor:
+            tenant_names = [name for name in executor.map(create_tenant, new_tenant_names) if name]
         
         # Insert tenant records into auth.companies table
         auth_conn_str = create_connection_string('auth', username, password, host, port)
         auth_engine = my_create_engine(auth_conn_str)
         
-        with auth_engine.connect() as connection:
-            for tenant_name in tenant_names:
-                try:
-                    connection.execute(text(f"INSERT INTO companies (db_name, name, email, password) VALUES ('{tenant_name}', '{tenant_name}', '{tenant_name}@example.com', '{tenant_name}')"))
+        if tenant_names:
+            # Register every tenant with one batched, parameterized INSERT
+            companies = [
+                {
+                    'db_name': tenant_name,
+                    'name': tenant_name,
+                    'email': f"{tenant_name}@example.com",
+                    'password': tenant_name,
+                }
+                for tenant_name in tenant_names
+            ]
+            try:
+                with auth_engine.begin() as connection:
+                    connection.execute(text(REGISTER_COMPANY_SQL), companies)
+                for tenant_name in tenant_names:
                     print(f"Registered tenant {tenant_name} in auth.companies")
-                except Exception as e:
-                    print(f"ERROR: Failed to register tenant {tenant_name} in companies table: {e}")
-                    # Continue with other tenants
-            
-            connection.commit()
+            except Exception as e:
+                print(f"ERROR: Failed to register tenants in companies table: {e}")
         
         print(f"Migrations completed - created {len(tenant_names)} tenant databases")
         return True
@@ -4,9 +4,16 @@ Tenant Migration Runner
 This script runs tenant-specific migrations on all tenant databases.
 """
 
+import asyncio
+import atexit
+import functools
+import json
+import logging
+import logging.handlers
 import os
+import queue
 import sys
-import importlib.util
+import types
 from pathlib import Path
 import hashlib
 from datetime import datetime
@@ -15,8 +22,29 @@ from datetime import datetime
 project_root = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(project_root))
 
+# Upper bound on tenant databases migrated concurrently (one connection each)
+MAX_CONCURRENT_TENANTS = 32
+
+logger = logging.getLogger("tenant_migrate")
+
+def setup_logging():
+    """Route runner output through a queue so the migration loop never waits on stdout.
+    
+    Returns the started listener, which writes every record from one thread.
+    """
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+@functools.lru_cache(maxsize=1)
 def get_db_credentials():
-    """Get database credentials from environment variables."""
+    """Get database credentials from environment variables (loaded once per run)."""
     from dotenv import load_dotenv
     load_dotenv(project_root / ".env")
     
@@ -27,26 +55,101 @@ def get_db_credentials():
     
     return username, password, host, port
 
+@functools.lru_cache(maxsize=None)
 def create_connection_string(db_name, username, password, host, port):
-    """Create a PostgreSQL connection string for the specified database."""
-    return f"postgresql://{username}:{password}@{host}:{port}/{db_name}"
+    """Create a PostgreSQL URL for the specified database (psycopg 3 driver).
+    
+    URL.create quotes the credentials, so passwords containing @ : / or % stay intact.
+    """
+    from sqlalchemy.engine import URL
+    
+    return URL.create(
+        drivername="postgresql+psycopg",
+        username=username,
+        password=password,
+        host=host,
+        port=int(port) if port else None,
+        database=db_name
+    )
+
+# Engine options shared by the sync and async engines. Each database is
+# worked on by one task at a time, so keep a single warm connection.
+# Statements run more than once per connection (the lock and applied
+# checks) are prepared server-side after first use; history rows are
+# written with COPY, which is never prepared.
+ENGINE_OPTIONS = {
+    'pool_recycle': 3600,
+    'pool_size': 1,
+    'pool_pre_ping': True,
+    'connect_args': {"prepare_threshold": 1}
+}
+
+# One engine per database for the whole run, shared by every helper
+_ENGINES = {}
+_ASYNC_ENGINES = {}
+
+def get_engine(db_name):
+    """Return the cached engine for db_name, creating it on first use."""
+    engine = _ENGINES.get(db_name)
+    if engine is None:
+        from sqlalchemy import create_engine
+        
+        username, password, host, port = get_db_credentials()
+        engine = create_engine(
+            create_connection_string(db_name, username, password, host, port),
+            **ENGINE_OPTIONS
+        )
+        _ENGINES[db_name] = engine
+    return engine
+
+def get_async_engine(db_name):
+    """Return the cached async engine for db_name, creating it on first use."""
+    engine = _ASYNC_ENGINES.get(db_name)
+    if engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        
+        username, password, host, port = get_db_credentials()
+        engine = create_async_engine(
+            create_connection_string(db_name, username, password, host, port),
+            **ENGINE_OPTIONS
+        )
+        _ASYNC_ENGINES[db_name] = engine
+    return engine
+
+def release_engine(db_name):
+    """Close the idle connections of a cached engine, keeping open connections bounded."""
+    engine = _ENGINES.get(db_name)
+    if engine is not None:
+        engine.dispose()
+
+async def release_async_engine(db_name):
+    """Close the idle connections of a cached async engine."""
+    engine = _ASYNC_ENGINES.get(db_name)
+    if engine is not None:
+        await engine.dispose()
+
+async def dispose_async_engines():
+    for engine in _ASYNC_ENGINES.values():
+        await engine.dispose()
+
+@atexit.register
+def dispose_engines():
+    for engine in _ENGINES.values():
+        engine.dispose()
 
 def get_tenant_databases():
     """Get list of tenant databases from auth.companies table."""
-    from sqlalchemy import create_engine, text
-    
-    username, password, host, port = get_db_credentials()
-    
-    def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-        return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
+    from sqlalchemy import text
     
     # Connect to auth database to get tenant list
-    auth_conn_str = create_connection_string('auth', username, password, host, port)
-    auth_engine = my_create_engine(auth_conn_str)
+    auth_engine = get_engine('auth')
     
+    # Unordered and streamed in batches; callers that display the list sort it
     with auth_engine.connect() as connection:
-        result = connection.execute(text("SELECT db_name FROM companies ORDER BY db_name"))
-        tenant_dbs = [row[0] for row in result.fetchall()]
+        result = connection.execution_options(stream_results=True, yield_per=1000).execute(
+            text("SELECT db_name FROM companies")
+        )
+        tenant_dbs = list(result.scalars())
     
     return tenant_dbs
 
@@ -55,391 +158,443 @@ def get_tenant_migration_files():
     tenant_migrations_dir = project_root / "migrations" / "tenant_versions"
     
     if not tenant_migrations_dir.exists():
-        print(f"Tenant migrations directory not found: {tenant_migrations_dir}")
+        logger.info(f"Tenant migrations directory not found: {tenant_migrations_dir}")
         return []
     
-    migration_files = []
-    for file_path in tenant_migrations_dir.glob("*.py"):
-        if file_path.name != "__init__.py":
-            migration_files.append(file_path)
+    # scandir entries carry their file type, so no per-file stat() is needed
+    with os.scandir(tenant_migrations_dir) as entries:
+        migration_files = [
+            Path(entry.path) for entry in entries
+            if entry.name.endswith(".py") and entry.name != "__init__.py" and entry.is_file()
+        ]
     
     # Sort by filename to ensure proper order
-    migration_files.sort()
+    migration_files.sort(key=lambda file_path: file_path.name)
     return migration_files
 
-def create_migration_tracking_table(tenant_db):
-    """Create migration tracking table in tenant database if it doesn't exist."""
-    from sqlalchemy import create_engine, text
-    
-    username, password, host, port = get_db_credentials()
-    
-    def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-        return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
-    
-    tenant_conn_str = create_connection_string(tenant_db, username, password, host, port)
-    tenant_engine = my_create_engine(tenant_conn_str)
-    
-    with tenant_engine.connect() as connection:
-        # Create migration tracking table
-        connection.execute(text("""
-            CREATE TABLE IF NOT EXISTS migration_history (
-                id SERIAL PRIMARY KEY,
-                migration_file VARCHAR(255) NOT NULL,
-                migration_hash VARCHAR(64) NOT NULL,
-                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status VARCHAR(20) DEFAULT 'applied',
-                checkpoint_data TEXT
-            )
-        """))
-        connection.commit()
+def create_migration_tracking_table(connection, checkpoint_name):
+    """Create migration tracking table if it doesn't exist and checkpoint the tenant database."""
+    from sqlalchemy import text
+    
+    # Create migration tracking table, converting older tables that
+    # stored checkpoint data as TEXT
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS migration_history (
+            id SERIAL PRIMARY KEY,
+            migration_file VARCHAR(255) NOT NULL,
+            migration_hash VARCHAR(64) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status VARCHAR(20) DEFAULT 'applied',
+            checkpoint_data JSONB
+        );
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM pg_catalog.pg_attribute
+                WHERE attrelid = 'migration_history'::regclass
+                AND attname = 'checkpoint_data' AND atttypid = 'text'::regtype
+            ) THEN
+                ALTER TABLE migration_history
+                ALTER COLUMN checkpoint_data TYPE JSONB USING to_jsonb(checkpoint_data);
+            END IF;
+        END $$
+    """))
+    return create_checkpoint(connection, checkpoint_name)
 
 def get_migration_hash(migration_file):
     """Calculate hash of migration file content for tracking."""
-    with open(migration_file, 'r') as f:
-        content = f.read()
-    return hashlib.sha256(content.encode()).hexdigest()
+    # The same file is hashed once per tenant, so cache on its stat
+    stat = os.stat(migration_file)
+    return _hash_file(str(migration_file), stat.st_mtime_ns, stat.st_size)
 
-def get_applied_migrations(tenant_db):
-    """Get list of applied migrations for a tenant database."""
-    from sqlalchemy import create_engine, text
-    
-    username, password, host, port = get_db_credentials()
-    
-    def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-        return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
-    
-    tenant_conn_str = create_connection_string(tenant_db, username, password, host, port)
-    tenant_engine = my_create_engine(tenant_conn_str)
-    
-    try:
-        with tenant_engine.connect() as connection:
-            result = connection.execute(text("""
-                SELECT migration_file, migration_hash, applied_at 
-                FROM migration_history 
-                WHERE status = 'applied'
-                ORDER BY applied_at
-            """))
-            return [(row[0], row[1], row[2]) for row in result.fetchall()]
-    except Exception:
-        # Migration history table doesn't exist yet
-        return []
+def _new_digest():
+    """SHA-256 for change tracking only, letting OpenSSL pick its fastest backend."""
+    return hashlib.new('sha256', usedforsecurity=False)
 
-def create_checkpoint(tenant_db, checkpoint_name):
-    """Create a checkpoint before running migrations."""
-    from sqlalchemy import create_engine, text
-    
-    username, password, host, port = get_db_credentials()
-    
-    def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-        return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
-    
-    tenant_conn_str = create_connection_string(tenant_db, username, password, host, port)
-    tenant_engine = my_create_engine(tenant_conn_str)
+@functools.lru_cache(maxsize=None)
+def _hash_file(path, mtime_ns, size):
+    """Hash a file's bytes, cached per path, modification time and size.
+    
+    Line endings are normalized to LF, as reading the file in text mode did,
+    so a CRLF checkout keeps the hashes already recorded in migration_history.
+    """
+    digest = _new_digest()
+    with open(path, 'rb') as f:
+        pending_cr = False
+        for chunk in iter(lambda: f.read(65536), b''):
+            # Hold back a trailing CR, it may start a CRLF split across chunks
+            if pending_cr:
+                chunk = b'\r' + chunk
+            pending_cr = chunk.endswith(b'\r')
+            if pending_cr:
+                chunk = chunk[:-1]
+            digest.update(chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n'))
+        if pending_cr:
+            digest.update(b'\n')
+    return digest.hexdigest()
+
+def has_migration_history(connection):
+    """Check whether the migration tracking table exists in a tenant database."""
+    from sqlalchemy import text
     
-    with tenant_engine.connect() as connection:
-        # Get current database schema info for checkpoint
-        result = connection.execute(text("""
-            SELECT table_name 
-            FROM information_schema.tables 
-            WHERE table_schema = 'public'
-            ORDER BY table_name
-        """))
-        tables = [row[0] for row in result.fetchall()]
-        
-        checkpoint_data = {
-            'timestamp': datetime.now().isoformat(),
-            'tables': tables,
-            'checkpoint_name': checkpoint_name
-        }
-        
-        # Store checkpoint in migration history
-        connection.execute(text("""
-            INSERT INTO migration_history (migration_file, migration_hash, status, checkpoint_data)
-            VALUES (:checkpoint_name, 'checkpoint', 'checkpoint', :data)
-        """), {
-            'checkpoint_name': checkpoint_name,
-            'data': str(checkpoint_data)
-        })
-        connection.commit()
-        return checkpoint_data
-
-def rollback_to_checkpoint(tenant_db, checkpoint_name):
-    """Rollback to a specific checkpoint."""
-    from sqlalchemy import create_engine, text
-    
-    username, password, host, port = get_db_credentials()
-    
-    def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-        return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
-    
-    tenant_conn_str = create_connection_string(tenant_db, username, password, host, port)
-    tenant_engine = my_create_engine(tenant_conn_str)
-    
-    with tenant_engine.connect() as connection:
-        # Get checkpoint data
-        result = connection.execute(text("""
-            SELECT checkpoint_data 
+    return connection.execute(text("SELECT to_regclass('migration_history')")).scalar() is not None
+
+def get_applied_migrations(connection):
+    """Get list of applied migrations for a tenant database with migration tracking."""
+    from sqlalchemy import text
+    
+    result = connection.execute(text("""
+        SELECT migration_file, migration_hash, applied_at 
+        FROM migration_history 
+        WHERE status = 'applied'
+        ORDER BY applied_at, id
+    """))
+    return [(row[0], row[1], row[2]) for row in result]
+
+def create_checkpoint(connection, checkpoint_name):
+    """Create a checkpoint before running migrations, inside the caller's transaction."""
+    from sqlalchemy import text
+    
+    # Get current database schema info for checkpoint
+    # Read the catalog directly, the information_schema view is slow
+    result = connection.execute(text("""
+        SELECT c.relname 
+        FROM pg_catalog.pg_class c 
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace 
+        WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p', 'v', 'f')
+        ORDER BY c.relname
+    """))
+    tables = list(result.scalars())
+    
+    checkpoint_data = {
+        'timestamp': datetime.now().isoformat(),
+        'tables': tables,
+        'checkpoint_name': checkpoint_name
+    }
+    
+    # Store checkpoint in migration history
+    connection.execute(text("""
+        INSERT INTO migration_history (migration_file, migration_hash, status, checkpoint_data)
+        VALUES (:checkpoint_name, 'checkpoint', 'checkpoint', CAST(:data AS JSONB))
+    """), {
+        'checkpoint_name': checkpoint_name,
+        'data': json.dumps(checkpoint_data)
+    })
+    return checkpoint_data
+
+@functools.lru_cache(maxsize=None)
+def compile_migration(migration_file):
+    """Read and compile a migration file once per run."""
+    return compile(migration_file.read_bytes(), str(migration_file), 'exec')
+
+def load_migration(migration_file):
+    """Execute a migration's compiled code in a fresh module.
+    
+    Each call gets its own module because the runner sets the module's
+    ``op`` for the tenant being migrated, and tenants run concurrently.
+    """
+    tenant_migration = types.ModuleType("tenant_migration")
+    tenant_migration.__file__ = str(migration_file)
+    exec(compile_migration(migration_file), tenant_migration.__dict__)
+    return tenant_migration
+
+async def lock_and_check_applied(connection, migration_file, migration_hash):
+    """Lock a migration for this transaction and check whether it is already applied.
+    
+    The lock and the history lookup are pipelined over psycopg, so they cost
+    one round trip instead of two.
+    """
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+    async with driver_connection.pipeline(), driver_connection.cursor() as cursor:
+        # Hold a transaction-scoped lock so another runner on this tenant
+        # can't apply the same migration concurrently
+        await cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f'mig:{migration_file.name}',))
+        await cursor.execute("""
+            SELECT 1 
             FROM migration_history 
-            WHERE migration_file = :checkpoint_name AND status = 'checkpoint'
-            ORDER BY applied_at DESC 
+            WHERE migration_file = %s AND migration_hash = %s AND status = 'applied'
             LIMIT 1
-        """), {'checkpoint_name': checkpoint_name})
-        
-        checkpoint_row = result.fetchone()
-        if not checkpoint_row:
-            print(f"No checkpoint '{checkpoint_name}' found for {tenant_db}")
-            return False
-        
-        # Mark failed migrations since checkpoint
-        connection.execute(text("""
-            UPDATE migration_history 
-            SET status = 'rolled_back' 
-            WHERE applied_at > (
-                SELECT applied_at FROM migration_history 
-                WHERE migration_file = :checkpoint_name AND status = 'checkpoint'
-                ORDER BY applied_at DESC LIMIT 1
-            ) AND status = 'applied'
-        """), {'checkpoint_name': checkpoint_name})
-        
-        connection.commit()
-        print(f"Rolled back {tenant_db} to checkpoint: {checkpoint_name}")
-        return True
-
-def record_migration_success(tenant_db, migration_file, migration_hash):
-    """Record successful migration in tracking table."""
-    from sqlalchemy import create_engine, text
-    
-    username, password, host, port = get_db_credentials()
-    
-    def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-        return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
-    
-    tenant_conn_str = create_connection_string(tenant_db, username, password, host, port)
-    tenant_engine = my_create_engine(tenant_conn_str)
-    
-    with tenant_engine.connect() as connection:
-        connection.execute(text("""
-            INSERT INTO migration_history (migration_file, migration_hash, status)
-            VALUES (:file, :hash, 'applied')
-        """), {
-            'file': migration_file.name,
-            'hash': migration_hash
-        })
-        connection.commit()
-
-def run_tenant_migration(tenant_db, migration_file):
-    """Run a specific migration on a tenant database with checkpoint support."""
-    from sqlalchemy import create_engine
+        """, (migration_file.name, migration_hash))
+        return await cursor.fetchone() is not None
+
+async def bulk_record_migrations(connection, rows):
+    """Record successful migrations in tracking table, as part of the caller's transaction.
+    
+    The rows are streamed with COPY, which stays cheap however many
+    migrations a tenant is catching up on.
+    """
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+    async with driver_connection.cursor() as cursor:
+        async with cursor.copy(
+            "COPY migration_history (migration_file, migration_hash, status) FROM STDIN"
+        ) as copy:
+            for row in rows:
+                await copy.write_row(row)
+
+def run_tenant_migration(connection, tenant_db, migration_file, migration_hash, records):
+    """Run a specific migration on an open tenant connection, inside the caller's transaction.
+    
+    Alembic needs a sync connection, so the async runner calls this through
+    ``AsyncConnection.run_sync``.
+    """
     from alembic.runtime.migration import MigrationContext
     from alembic.operations import Operations
     
-    username, password, host, port = get_db_credentials()
-    
-    def my_create_engine(conn_str, pool_recycle=3600, pool_size=8):
-        return create_engine(conn_str, pool_recycle=pool_recycle, pool_size=pool_size)
+    # Import the migration file dynamically
+    tenant_migration = load_migration(migration_file)
     
-    migration_hash = get_migration_hash(migration_file)
-    applied_migrations = get_applied_migrations(tenant_db)
+    if not hasattr(tenant_migration, 'upgrade'):
+        logger.error(f"No upgrade function found in {migration_file.name}")
+        return False
     
-    # Check if migration already applied with same hash
-    for applied_file, applied_hash, applied_at in applied_migrations:
-        if applied_file == migration_file.name and applied_hash == migration_hash:
-            print(f"Skipped {migration_file.name} on {tenant_db} (already applied)")
-            return True
+    # Set up the alembic context for direct execution
+    mc = MigrationContext.configure(connection)
+    ops = Operations(mc)
     
-    # Import the migration file dynamically
-    spec = importlib.util.spec_from_file_location("tenant_migration", migration_file)
-    tenant_migration = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(tenant_migration)
+    # Store the op context for the migration functions
+    tenant_migration.op = ops
     
-    # Connect to the tenant database
-    tenant_conn_str = create_connection_string(tenant_db, username, password, host, port)
-    tenant_engine = my_create_engine(tenant_conn_str)
+    # Run the migration and queue its history row
+    tenant_migration.upgrade()
+    records.append((migration_file.name, migration_hash, 'applied'))
     
+    logger.info(f"Applied {migration_file.name} to {tenant_db}")
+    return True
+
+async def prepare_tenant(tenant_db, checkpoint_name):
+    """Set up tracking and the run's checkpoint, returning the tenant's applied migrations."""
     try:
-        with tenant_engine.connect() as connection:
-            # Set up the alembic context for direct execution
-            mc = MigrationContext.configure(connection)
-            ops = Operations(mc)
-            
-            # Store the op context for the migration functions
-            tenant_migration.op = ops
-            
-            # Run the migration
-            if hasattr(tenant_migration, 'upgrade'):
-                tenant_migration.upgrade()
-                connection.commit()
-                
-                # Record successful migration
-                record_migration_success(tenant_db, migration_file, migration_hash)
-                print(f"Applied {migration_file.name} to {tenant_db}")
-                return True
-            else:
-                print(f"No upgrade function found in {migration_file.name}")
-                return False
+        async with get_async_engine(tenant_db).begin() as connection:
+            await connection.run_sync(create_migration_tracking_table, checkpoint_name)
+            applied_migrations = await connection.run_sync(get_applied_migrations)
+        return {(migration_file, migration_hash) for migration_file, migration_hash, _ in applied_migrations}
+    except Exception as e:
+        # Never migrate a tenant that has no checkpoint to fall back to
+        logger.error(f"ERROR: Could not initialize tracking for {tenant_db}: {e}")
+        return None
+    finally:
+        await release_async_engine(tenant_db)
+
+async def apply_tenant_migrations(tenant_db, migration_files, checkpoint_name, applied_set):
+    """Apply all migrations to a checkpointed tenant database and roll back on failure."""
+    migration_file = None
+    try:
+        # The tenant's migrations and their history rows share a single
+        # transaction, so a failure leaves the tenant at its checkpoint
+        records = []
+        async with get_async_engine(tenant_db).connect() as connection:
+            async with connection.begin() as transaction:
+                for migration_file in migration_files:
+                    migration_hash = get_migration_hash(migration_file)
+                    
+                    # Check if migration already applied with same hash, then
+                    # re-check under the lock, another runner may have applied it since
+                    if ((migration_file.name, migration_hash) in applied_set
+                            or await lock_and_check_applied(connection, migration_file, migration_hash)):
+                        logger.info(f"Skipped {migration_file.name} on {tenant_db} (already applied)")
+                        continue
+                    
+                    if not await connection.run_sync(
+                        run_tenant_migration, tenant_db, migration_file, migration_hash, records
+                    ):
+                        await transaction.rollback()
+                        break
+                else:
+                    if records:
+                        await bulk_record_migrations(connection, records)
+                    return True
+        
+        # Migration failed; the rollback above returned the tenant to its checkpoint
+        logger.info(f"Rolled back {tenant_db} to checkpoint: {checkpoint_name}")
+        return False
                 
     except Exception as e:
-        print(f"ERROR: Failed to apply {migration_file.name} to {tenant_db}: {e}")
+        if migration_file is None:
+            # Failed before any migration ran (e.g. connecting), nothing to roll back
+            logger.error(f"ERROR: Failed to migrate {tenant_db}: {e}")
+            return False
+        logger.error(f"ERROR: Failed to apply {migration_file.name} to {tenant_db}: {e}")
+        # Leaving the transaction block on an exception rolled it back
+        logger.info(f"Rolled back {tenant_db} to checkpoint: {checkpoint_name}")
         return False
+    finally:
+        # Only the tenants being worked on keep connections open
+        await release_async_engine(tenant_db)
+
+async def migrate_tenants(tenant_dbs, migration_files, checkpoint_name):
+    """Prepare and migrate tenants concurrently, returning the successful and failed sets."""
+    successful_dbs = set()
+    failed_dbs = set()
+    
+    # Tenants are independent and the work is I/O-bound, so they run as
+    # concurrent tasks, bounded to keep the number of open connections fixed
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TENANTS)
+    
+    async def bounded(tenant_db, coroutine):
+        # One tenant's unexpected error must never cancel the others
+        async with semaphore:
+            try:
+                return await coroutine
+            except Exception as e:
+                logger.error(f"ERROR: Unexpected failure on {tenant_db}: {e}")
+                return None
+    
+    try:
+        # Initialize tracking tables on all tenant databases, checkpoint each
+        # one once for the whole run and load what it has applied
+        logger.info("\nInitializing migration tracking...")
+        results = await asyncio.gather(*(
+            bounded(tenant_db, prepare_tenant(tenant_db, checkpoint_name)) for tenant_db in tenant_dbs
+        ))
+        applied = {}
+        for tenant_db, applied_set in zip(tenant_dbs, results):
+            if applied_set is None:
+                failed_dbs.add(tenant_db)
+            else:
+                applied[tenant_db] = applied_set
+        
+        # Run migrations, each tenant file by file
+        pending_dbs = [tenant_db for tenant_db in tenant_dbs if tenant_db not in failed_dbs]
+        if pending_dbs:
+            logger.info(f"\nRunning migrations: {', '.join(f.name for f in migration_files)}")
+            
+            results = await asyncio.gather(*(
+                bounded(tenant_db, apply_tenant_migrations(tenant_db, migration_files, checkpoint_name, applied[tenant_db]))
+                for tenant_db in pending_dbs
+            ))
+            # Results come back in tenant order
+            for tenant_db, success in zip(pending_dbs, results):
+                if success:
+                    successful_dbs.add(tenant_db)
+                else:
+                    failed_dbs.add(tenant_db)
+    finally:
+        await dispose_async_engines()
+    
+    return successful_dbs, failed_dbs
 
 def run_all_tenant_migrations():
     """Run all tenant migrations on all tenant databases with checkpoint recovery."""
     try:
-        print("Running tenant migrations with checkpoint recovery...")
+        logger.info("Running tenant migrations with checkpoint recovery...")
         
         # Check credentials
         username, password, host, port = get_db_credentials()
         if not username or not password:
-            print("ERROR: Database credentials not configured")
+            logger.error("ERROR: Database credentials not configured")
             return False
         
         # Get tenant databases
         tenant_dbs = get_tenant_databases()
         if not tenant_dbs:
-            print("No tenant databases found")
+            logger.info("No tenant databases found")
             return True
         
-        print(f"Found {len(tenant_dbs)} tenant databases: {', '.join(tenant_dbs)}")
+        logger.info(f"Found {len(tenant_dbs)} tenant databases: {', '.join(tenant_dbs)}")
         
         # Get migration files
         migration_files = get_tenant_migration_files()
         if not migration_files:
-            print("No tenant migration files found")
+            logger.info("No tenant migration files found")
             return True
         
-        print(f"Found {len(migration_files)} migration files")
-        
-        # Initialize tracking tables on all tenant databases
-        print("\nInitializing migration tracking...")
-        for tenant_db in tenant_dbs:
-            try:
-                create_migration_tracking_table(tenant_db)
-            except Exception as e:
-                print(f"WARNING: Could not initialize tracking for {tenant_db}: {e}")
-        
-        # Track results
-        successful_dbs = []
-        failed_dbs = []
-        skipped_dbs = []
+        logger.info(f"Found {len(migration_files)} migration files")
         
         # Create checkpoint name based on current timestamp
         checkpoint_name = f"pre_migration_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
-        # Run migrations
-        for migration_file in migration_files:
-            print(f"\nRunning migration: {migration_file.name}")
-            
-            for tenant_db in tenant_dbs:
-                if tenant_db in failed_dbs:
-                    print(f"Skipped {tenant_db} (already failed)")
-                    continue
-                
-                try:
-                    # Create checkpoint before applying migration
-                    create_checkpoint(tenant_db, checkpoint_name)
-                    
-                    # Apply migration
-                    success = run_tenant_migration(tenant_db, migration_file)
-                    
-                    if success:
-                        if tenant_db not in successful_dbs:
-                            successful_dbs.append(tenant_db)
-                    else:
-                        # Migration failed, rollback to checkpoint
-                        print(f"Rolling back {tenant_db} to checkpoint...")
-                        rollback_to_checkpoint(tenant_db, checkpoint_name)
-                        if tenant_db not in failed_dbs:
-                            failed_dbs.append(tenant_db)
-                            
-                except Exception as e:
-                    print(f"ERROR: Failed to apply {migration_file.name} to {tenant_db}: {e}")
-                    try:
-                        # Try to rollback to checkpoint
-                        rollback_to_checkpoint(tenant_db, checkpoint_name)
-                    except Exception as rollback_error:
-                        print(f"ERROR: Could not rollback {tenant_db}: {rollback_error}")
-                    
-                    if tenant_db not in failed_dbs:
-                        failed_dbs.append(tenant_db)
+        # psycopg's async driver can't run on Windows' default Proactor loop
+        if sys.platform == 'win32':
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        
+        successful_dbs, failed_dbs = asyncio.run(
+            migrate_tenants(tenant_dbs, migration_files, checkpoint_name)
+        )
         
         # Print summary
-        print(f"\n{'='*60}")
-        print("MIGRATION SUMMARY")
-        print(f"{'='*60}")
-        print(f"Total tenant databases: {len(tenant_dbs)}")
-        print(f"Successful migrations: {len(successful_dbs)}")
-        print(f"Failed migrations: {len(failed_dbs)}")
+        logger.info(f"\n{'='*60}")
+        logger.info("MIGRATION SUMMARY")
+        logger.info(f"{'='*60}")
+        logger.info(f"Total tenant databases: {len(tenant_dbs)}")
+        logger.info(f"Successful migrations: {len(successful_dbs)}")
+        logger.info(f"Failed migrations: {len(failed_dbs)}")
         
         if successful_dbs:
-            print(f"\nSuccessful databases:")
-            for db in successful_dbs:
-                print(f"  ✓ {db}")
+            logger.info(f"\nSuccessful databases:")
+            for db in sorted(successful_dbs):
+                logger.info(f"  ✓ {db}")
         
         if failed_dbs:
-            print(f"\nFailed databases (rolled back to checkpoint):")
-            for db in failed_dbs:
-                print(f"  ✗ {db}")
+            logger.info(f"\nFailed databases (rolled back to checkpoint):")
+            for db in sorted(failed_dbs):
+                logger.info(f"  ✗ {db}")
         
-        print(f"\nCheckpoint name used: {checkpoint_name}")
-        print(f"\nTenant migrations completed!")
+        logger.info(f"\nCheckpoint name used: {checkpoint_name}")
+        logger.info(f"\nTenant migrations completed!")
         
         return len(failed_dbs) == 0
         
     except Exception as e:
-        print(f"ERROR: Tenant migration failed: {e}")
+        logger.error(f"ERROR: Tenant migration failed: {e}")
         return False
 
 def show_migration_history():
     """Show migration history for all tenant databases."""
     try:
-        tenant_dbs = get_tenant_databases()
+        tenant_dbs = sorted(get_tenant_databases())
         if not tenant_dbs:
-            print("No tenant databases found")
+            logger.info("No tenant databases found")
             return
         
-        print("Migration History")
-        print("=" * 60)
+        logger.info("Migration History")
+        logger.info("=" * 60)
         
         for tenant_db in tenant_dbs:
-            print(f"\n{tenant_db}:")
+            logger.info(f"\n{tenant_db}:")
             try:
-                applied_migrations = get_applied_migrations(tenant_db)
+                with get_engine(tenant_db).connect() as connection:
+                    # Tenants that were never migrated have no tracking table yet
+                    applied_migrations = get_applied_migrations(connection) if has_migration_history(connection) else []
                 if applied_migrations:
                     for migration_file, migration_hash, applied_at in applied_migrations:
-                        print(f"  ✓ {migration_file} ({applied_at})")
+                        logger.info(f"  ✓ {migration_file} ({applied_at})")
                 else:
-                    print("  No migrations applied")
+                    logger.info("  No migrations applied")
             except Exception as e:
-                print(f"  ERROR: Could not read history: {e}")
+                logger.error(f"  ERROR: Could not read history: {e}")
+            finally:
+                release_engine(tenant_db)
     except Exception as e:
-        print(f"ERROR: Could not show migration history: {e}")
+        logger.error(f"ERROR: Could not show migration history: {e}")
 
 def main():
     """Main function."""
-    print("Tenant Migration Runner")
-    print("=" * 50)
+    logger.info("Tenant Migration Runner")
+    logger.info("=" * 50)
     
     if len(sys.argv) > 1:
         if sys.argv[1] == "--list":
             # List tenant databases
             try:
-                tenant_dbs = get_tenant_databases()
-                print(f"Tenant databases ({len(tenant_dbs)}):")
+                tenant_dbs = sorted(get_tenant_databases())
+                logger.info(f"Tenant databases ({len(tenant_dbs)}):")
                 for db in tenant_dbs:
-                    print(f"  - {db}")
+                    logger.info(f"  - {db}")
             except Exception as e:
-                print(f"ERROR: Could not list tenant databases: {e}")
+                logger.error(f"ERROR: Could not list tenant databases: {e}")
             return
         elif sys.argv[1] == "--history":
             # Show migration history
             show_migration_history()
             return
         elif sys.argv[1] == "--help":
-            print("Usage:")
-            print("  python run_tenant_migrations.py           # Run all tenant migrations")
-            print("  python run_tenant_migrations.py --list    # List all tenant databases")
-            print("  python run_tenant_migrations.py --history # Show migration history")
-            print("  python run_tenant_migrations.py --help    # Show this help")
+            logger.info("Usage:")
+            logger.info("  python run_tenant_migrations.py           # Run all tenant migrations")
+            logger.info("  python run_tenant_migrations.py --list    # List all tenant databases")
+            logger.info("  python run_tenant_migrations.py --history # Show migration history")
+            logger.info("  python run_tenant_migrations.py --help    # Show this help")
             return
     
     # Run migrations
@@ -447,4 +602,9 @@ def main():
     sys.exit(0 if success else 1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    listener = setup_logging()
+    try:
+        main()
+    finally:
+        # Flush queued output before exiting
+        listener.stop() 
\ No newline at end of file